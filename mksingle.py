@@ -9,14 +9,21 @@ import os.path
 import re
 import subprocess
 import sys
+import tempfile
 import time
 import token
 import tokenize
 import zipfile
 
 
-def Minify(source, output_func):
-  """Minifies Python (2.4, 2.5, 2.6 or 2.7) source code.
+# Indentation strings for the usual nesting depths. tokenize.generate_tokens
+# has no limit on indentation (only compile() has), so MinifyToStr extends a
+# copy of this for deeper levels.
+_INDENTS = tuple(' ' * i for i in xrange(128))
+
+
+def MinifyToStr(source):
+  """Minifies Python (2.4, 2.5, 2.6 or 2.7) source code, returns a str.
 
   This function was tested and it works identically (consistently) in Python
   2.4, 2.5, 2.6 and 2.7.
@@ -50,19 +57,26 @@ def Minify(source, output_func):
 
   Args:
     source: Python source code to minify. Can be str, buffer (or anything
-      convertible to a buffer, e.g. bytearray), a readline method of a
-      file-object or an iterable of line strs.
-    output_func: Function which will be called with str arguments for each
-      output piece.
+      convertible to a buffer, e.g. bytearray), memoryview, a readline method
+      of a file-object or an iterable of line strs.
+
+  Returns:
+    The minified source code as a str.
   """
   if isinstance(source, unicode):
     raise TypeError
-  try:
-    buf = buffer(source)
-  except TypeError:
-    buf = None
+  if isinstance(source, str):
+    buf = source  # cStringIO can read a str directly, no need for a buffer.
+  elif hasattr(source, 'tobytes'):
+    # memoryview (Python 2.7) can't be converted to a buffer, and iterating
+    # over it would yield single characters, not lines.
+    buf = source.tobytes()
+  else:
+    try:
+      buf = buffer(source)
+    except TypeError:
+      buf = None
   if buf is not None:
-    import cStringIO
     # This also works, except it's different at the end of the partial line:
     # source = iter(line + '\n' for line in str(buf).splitlines()).next
     source = cStringIO.StringIO(buf).readline
@@ -77,66 +91,89 @@ def Minify(source, output_func):
   _COMMENT_OR_NL = (_COMMENT, _NL)
   _NAME_OR_NUMBER = (_NAME, _NUMBER)
 
+  output = []
+  append = output.append  # Faster than looking up the attribute each time.
   i = 0  # Indentation.
-  is_at_bol = is_at_bof = 1  # Beginning of line and file.
+  indents = list(_INDENTS)  # indents[i] == ' ' * i.
+  is_at_bol = 1  # Beginning of line.
   is_empty_indent = 0
-  pt, ps = -1, ''  # Previous token.
+  pt = -1  # Type of previous token.
   # There are small differences in tokenize.generate_tokens in Python
   # versions, but they don't affect us, so we don't care:
   # * In Python <=2.4, the final DEDENTs and ENDMARKER are not yielded.
   # * In Python <=2.5, the COMMENT ts contains the '\n', and a separate
   #   NL is not generated.
+  # Python 2 has no C tokenizer exposed, but tokenize.generate_tokens
+  # yields plain tuples (not namedtuples), and it gets its lines from the
+  # C readline of cStringIO above, so this is as fast as it gets.
   for tt, ts, _, _, _ in tokenize.generate_tokens(source):
     if tt == _INDENT:
       i += 1
+      if i == len(indents):
+        indents.append(' ' * i)
       is_empty_indent = 1
     elif tt == _DEDENT:
       if is_empty_indent:
-        output_func(' ' * i)  # TODO(pts): Merge with previous line.
-        output_func('pass\n')
+        append(indents[i])  # TODO(pts): Merge with previous line.
+        append('pass\n')
         is_empty_indent = 0
       i -= 1
     elif tt == _NEWLINE:
       if not is_at_bol:
-        output_func('\n')
-      is_at_bol, pt, ps = 1, -1, ''
+        append('\n')
+      is_at_bol, pt = 1, -1
     elif (tt == _STRING and is_at_bol or  # Module-level docstring etc.
           tt in _COMMENT_OR_NL):
       pass
     else:
       if is_at_bol:
-        output_func(' ' * i)
-        is_at_bol = is_at_bof = 0
+        append(indents[i])
+        is_at_bol = 0
       if pt in _NAME_OR_NUMBER and (tt in _NAME_OR_NUMBER or
           (tt == _STRING and ts[0] in 'rb')):
-        output_func(' ')
-      output_func(ts)
-      pt, ps, is_empty_indent = tt, ts, 0
+        append(' ')
+      append(ts)
+      pt, is_empty_indent = tt, 0
   if is_empty_indent:
-    output_func(' ' * i)
-    output_func('pass\n')
+    append(indents[i])
+    append('pass\n')
+  return ''.join(output)
+
+
+def Minify(source, output_func):
+  """Minifies Python source code, calls output_func with the result.
+
+  Args:
+    source: Python source code to minify, see MinifyToStr for details.
+    output_func: Function which will be called with a str argument for the
+      output, unless the output is empty.
+  """
+  code_mini = MinifyToStr(source)
+  if code_mini:
+    output_func(code_mini)
 
 
 # We could support \r and \t outside strings, Minify would remove them.
 UNSUPPORTED_CHARS_RE = re.compile(r'[^\na -~]+')
+# For the fast check: str.translate deletes the supported chars much faster
+# than UNSUPPORTED_CHARS_RE.search finds nothing.
+IDENTITY_TRANSLATE_TABLE = ''.join(map(chr, xrange(256)))
+SUPPORTED_CHARS = '\n' + ''.join(map(chr, xrange(32, 127)))
 
 
 def MinifyFile(file_name, code_orig):
-  i = code_orig.find('\n')
-  if i >= 0:
-    line1 = code_orig[:i]
-    if '-*- coding: ' in line1:
-      # We could support them by keeping this comment, but instead we opt
-      # for fully ASCII Python input files.
-      raise ValueError('-*- coding declarations not supported.')
-  match = UNSUPPORTED_CHARS_RE.search(code_orig)
-  if match:
+  # Only look at the beginning of the first line, to keep the scan short.
+  if '-*- coding: ' in code_orig[:256].split('\n', 1)[0]:
+    # We could support them by keeping this comment, but instead we opt
+    # for fully ASCII Python input files.
+    raise ValueError('-*- coding declarations not supported.')
+  if code_orig.translate(IDENTITY_TRANSLATE_TABLE, SUPPORTED_CHARS):
+    match = UNSUPPORTED_CHARS_RE.search(code_orig)
     raise ValueError('Unsupported chars in source: %r' % match.group(0))
   compile(code_orig, file_name, 'exec')  # Check for syntax errors.
-  output = []
-  Minify(code_orig, output.append)
-  code_mini = ''.join(output)
-  compile(code_mini, file_name, 'exec')  # Check for syntax errors.
+  code_mini = MinifyToStr(code_orig)
+  if __debug__:  # Skipped in `python -O'.
+    compile(code_mini, file_name, 'exec')  # Check for bugs in MinifyToStr.
   return code_mini
 
 # It's OK that this doesn't support the full PostScript syntax, it's enough to
@@ -156,21 +193,23 @@ POSTSCRIPT_TOKEN_RE = re.compile(
 
 
 def MinifyPostScript(pscode):
-  output = [' ']  # Sentinel for output[-1][-1].
+  output = []
+  append = output.append
+  last_char = ' '  # Last character of output.
   for match in POSTSCRIPT_TOKEN_RE.finditer(pscode):
-    if match.group(1):
-      output.append(match.group(1))
-    elif match.group(2):
-      output.append(match.group(2))
-    elif match.group(3):
-      t = match.group(3)
-      if t[0] != '/' and output[-1][-1] not in ')<>{}[]':
-        output.append(' ')
-      output.append(t)
-    elif match.group(4):
+    # At most one group matches, and if it does, it's nonempty.
+    g = match.lastindex
+    if g is None:  # Comment or whitespace.
+      continue
+    t = match.group(g)
+    if g == 3:
+      if t[0] != '/' and last_char not in ')<>{}[]':
+        append(' ')
+    elif g == 4:
       i = match.start()
       raise ValueError('Unknown PostScript syntax: %r' % pscode[i : i + 20])
-  output[0] = ''  # Remove sentinel.
+    append(t)
+    last_char = t[-1]
   return ''.join(output)
 
 
@@ -178,22 +217,27 @@ def MinifyPostScriptProcsets(file_name, code_orig):
   code_obj = compile(code_orig, file_name, 'exec')
   globals_dict = {}
   exec code_obj in globals_dict
-  for name in sorted(globals_dict):
-    if name.startswith('__'):
-      del globals_dict[name]
   names, pscodes = [], []
-  for name, pscode in sorted(globals_dict.iteritems()):
+  for name, pscode in sorted(
+      item for item in globals_dict.iteritems()
+      if not item[0].startswith('__')):
     names.append(name)
     if not isinstance(pscode, str):
       raise ValueError('Expected pscode as str, got: %r' % type(pscode))
+    # There are only a few procsets, so the per-call setup cost of
+    # MinifyPostScript is negligible. Minifying them in one call with a
+    # separator would need a separator which can't become part of a token.
     pscode = MinifyPostScript(pscode)
     if '%%' in pscode:
       raise ValueError('Unexpected %% in minified pscode.')
+    # Checking each pscode is enough, the '\n%%' separator doesn't contain
+    # a quote.
+    if "'''" in pscode:
+      raise ValueError("Unexpected ''' in minified pscode.")
     pscodes.append(pscode)
   if not pscodes:
     return ''
   pscodes_str = '\n%%'.join(pscodes)
-  assert "'''" not in pscodes_str
   return "%s=r'''%s\n'''.split('%%%%')" % (','.join(names), pscodes_str)
 
 
@@ -243,17 +287,32 @@ def new_zipinfo(file_name, file_mtime, permission_bits=0644):
   return zipinfo
 
 
+def ReadLibFile(file_name):
+  """Returns (file_mtime, data) for a file in lib/."""
+  f = open('lib/' + file_name, 'rb')
+  try:
+    # The zip(1) command also uses localtime. The ZIP file format doesn't
+    # store the time zone.
+    file_mtime = time.localtime(os.fstat(f.fileno()).st_mtime)[:6]
+    return file_mtime, f.read()
+  finally:
+    f.close()
+
+
+def ReadAndMinifyFile(file_name):
+  """Returns (file_mtime, code_mini) for a Python source file in lib/."""
+  file_mtime, code_orig = ReadLibFile(file_name)
+  return file_mtime, MinifyFile(file_name, code_orig)
+
+
 def main(argv):
   os.chdir(os.path.dirname(__file__))
   assert os.path.isfile('lib/pdfsizeopt/main.py')
-  zip_output_file_name = 't.zip'
   single_output_file_name = 'pdfsizeopt.single'
-  try:
-    os.remove(zip_output_file_name)
-  except OSError:
-    pass
 
-  zf = zipfile.ZipFile(zip_output_file_name, 'w', zipfile.ZIP_DEFLATED)
+  # No compression here, advzip below recompresses all members anyway.
+  zip_output = cStringIO.StringIO()
+  zf = zipfile.ZipFile(zip_output, 'w', zipfile.ZIP_STORED)
   time_now = time.localtime()[:6]
   try:
     for file_name in (
@@ -262,14 +321,9 @@ def main(argv):
         'pdfsizeopt/cff.py',
         'pdfsizeopt/float_util.py',
         'pdfsizeopt/main.py'):
-      code_orig = open('lib/' + file_name, 'rb').read()
-      # The zip(1) command also uses localtime. The ZIP file format doesn't
-      # store the time zone.
-      file_mtime = time.localtime(os.stat('lib/' + file_name).st_mtime)[:6]
-      code_mini = MinifyFile(file_name, code_orig)
-      # Compression effort doesn't matter, we run advzip below anyway.
+      file_mtime, code_mini = ReadAndMinifyFile(file_name)
       zf.writestr(new_zipinfo(file_name, file_mtime), code_mini)
-      del code_orig, code_mini  # Save memory.
+      del code_mini  # Save memory.
 
     # TODO(pts): Can we use `-m m'? Does it work in Python 2.0, 2.1, 2.2 and
     # 2.3? (So that we'd reach the proper error message.)
@@ -280,21 +334,31 @@ def main(argv):
                 'import m')
 
     file_name = 'pdfsizeopt/psproc.py'
-    code_orig = open('lib/' + file_name, 'rb').read()
-    file_mtime = time.localtime(os.stat('lib/' + file_name).st_mtime)[:6]
+    file_mtime, code_orig = ReadLibFile(file_name)
     code_mini = MinifyPostScriptProcsets(file_name, code_orig)
     zf.writestr(new_zipinfo(file_name, file_mtime), code_mini)
   finally:
     zf.close()
 
-  subprocess.check_call(('advzip', '-qz4', '--', zip_output_file_name))
+  data = zip_output.getvalue()
+  del zip_output  # Save memory.
 
-  f = open(zip_output_file_name, 'rb')
+  # advzip needs a file name, it can't read from stdin.
+  fd, zip_output_file_name = tempfile.mkstemp(suffix='.zip')
   try:
-    data = f.read()
+    f = os.fdopen(fd, 'wb')
+    try:
+      f.write(data)
+    finally:
+      f.close()
+    subprocess.check_call(('advzip', '-qz4', '--', zip_output_file_name))
+    f = open(zip_output_file_name, 'rb')
+    try:
+      data = f.read()
+    finally:
+      f.close()
   finally:
-    f.close()
-  os.remove(zip_output_file_name)
+    os.remove(zip_output_file_name)
 
   f = open(single_output_file_name, 'wb')
   try: